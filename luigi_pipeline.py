@@ -11,14 +11,130 @@
 
 import luigi
 from luigi.format import Nop
+import fnmatch
 import io
 import os
 import requests
-import pandas as pd
+from requests.adapters import HTTPAdapter
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+import shutil
 import tarfile
-import gzip
+
+# ISA-L inflate is ~2x faster than zlib and the igzip module
+# is a drop-in replacement for gzip; fall back if not installed
+try:
+    from isal import igzip as gzip
+except ImportError:
+    import gzip
+
+# pgzip inflates large archives with several threads;
+# only worth it above a size threshold, optional like isal
+try:
+    import pgzip
+except ImportError:
+    pgzip = None
 from pathlib import Path
 
+# members smaller than this are not worth thread startup
+PGZIP_MIN_SIZE = 32 * 1024 * 1024
+
+# one session for every download: the TCP+TLS handshake is paid
+# once and the connection reused across datasets
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
+
+# Shared pyarrow options for the tab-separated source tables
+TSV_PARSE = pacsv.ParseOptions(delimiter="\t")
+
+
+# Find files for every pattern in one walk of ds_dir.
+# Cheaper than one rglob per pattern: the tree is read once
+def scan_patterns(ds_dir, patterns):
+    found = {pattern: [] for pattern in patterns}
+    for root, _, files in os.walk(ds_dir):
+        for file_name in files:
+            for pattern in patterns:
+                if fnmatch.fnmatch(file_name, pattern):
+                    found[pattern].append(Path(root) / file_name)
+    return found
+
+
+# Tables are stored as parquet; accept the old .tsv spelling
+# of a pattern from the command line
+def parquet_pattern(pattern):
+    name, ext = os.path.splitext(pattern)
+    if ext == ".tsv":
+        ext = ".parquet"
+    return f"{name}{ext}"
+
+
+# Iterative os.scandir walk yielding files with the given suffix.
+# Faster than rglob: DirEntry caches the file type,
+# so there is no extra stat and no Path object per entry
+def walk_ext(root, ext):
+    stack = [str(root)]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith(ext):
+                    yield entry.path
+
+
+# Parse one accumulated section with pyarrow's threaded reader
+def read_section(buf, key):
+    # "Heading" block has no header row (was header=None in pandas)
+    read_options = pacsv.ReadOptions(autogenerate_column_names=(key == "Heading"))
+    return pacsv.read_csv(buf, read_options=read_options, parse_options=TSV_PARSE)
+
+
+# Convert tables into .parquet files: columnar, snappy-compressed,
+# several times smaller and faster to re-read than .tsv.
+# Sections matching prep_list are filtered and written as
+# "{key}_preprocessed.parquet" right away, skipping the unfiltered
+# intermediate that DataPreprocessing used to re-read from disk
+def separate_tables(fname, prep_list=(), cols_fordrop=()):
+    tables = {}
+    # binary mode: pyarrow decodes inside its C parser,
+    # no per-line UTF-8 decode in the Python loop
+    with open(fname, "rb") as f:
+        write_key = None
+        fio = io.BytesIO()
+        # iterate the file object directly instead of readlines(),
+        # so only the current section is buffered, not the whole file
+        for l in f:
+            # slice compare instead of startswith: no attribute
+            # lookup and call per data line
+            if l[:1] == b"[":
+                if write_key:
+                    fio.seek(0)
+                    tables[write_key] = read_section(fio, write_key)
+                fio = io.BytesIO()
+                # strip \r too: binary mode has no universal
+                # newlines, CRLF dumps reach here verbatim
+                write_key = l.strip(b"[]\r\n").decode()
+                continue
+            if write_key:
+                fio.write(l)
+        fio.seek(0)
+        tables[write_key] = read_section(fio, write_key)
+
+    # save into separate .parquet files
+    drop_set = frozenset(cols_fordrop)
+    patterns = [parquet_pattern(pattern) for pattern in prep_list]
+    for key, table in tables.items():
+        output_file = Path(fname).parent / f"{key}.parquet"
+        if any(fnmatch.fnmatch(output_file.name, pattern) for pattern in patterns):
+            # fused preprocessing: project the kept columns and
+            # write the final file in the same pass
+            keep = [c for c in table.column_names if c not in drop_set]
+            table = table.select(keep)
+            output_file = output_file.with_name(f"{key}_preprocessed.parquet")
+        pq.write_table(table, str(output_file), compression="snappy")
+
 
 class DownloadData(luigi.Task):
     """
@@ -38,31 +154,117 @@ class DownloadData(luigi.Task):
         )
 
     def run(self):
-        response = requests.get(
+        tar_path = self.output().path
+        etag_path = f"{tar_path}.etag"
+
+        # conditional GET: if a local copy and its ETag survive,
+        # ask the server whether the archive changed at all
+        headers = {}
+        if os.path.exists(tar_path) and os.path.exists(etag_path):
+            with open(etag_path) as f:
+                headers["If-None-Match"] = f.read().strip()
+
+        with SESSION.get(
             f"https://www.ncbi.nlm.nih.gov/geo/download/?acc={self.data_name}&format=file",
             stream=True,
-        )
+            headers=headers,
+        ) as response:
+            # 304: server copy unchanged, keep the local file
+            # and skip the whole download
+            if response.status_code == 304:
+                os.utime(tar_path)
+                return
+
+            # HTTP status check
+            if response.status_code != 200:
+                raise ValueError(f"Error of dataset downloading: {response.status_code}")
 
-        # HTTP status check
-        if response.status_code == 200:
             # create destination folder
             os.makedirs(self.dest_folder, exist_ok=True)
 
-            # save file from internet
+            # save file from internet chunk by chunk,
+            # so the whole archive never sits in RAM
             with self.output().open("w") as f:
-                f.write(response.content)
-        else:
-            raise ValueError(f"Error of dataset downloading: {response.status_code}")
+                for chunk in response.iter_content(chunk_size=1024 * 1024):
+                    if chunk:
+                        f.write(chunk)
+
+            # remember the ETag for the next run's conditional GET
+            etag = response.headers.get("ETag")
+            if etag:
+                with open(etag_path, "w") as f:
+                    f.write(etag)
+
+
+class ExtractOneMember(luigi.Task):
+    """
+    Extract a single .gz member from the archive
+    and split it into tables.
+    Separate task per member, so on a retry Luigi skips
+    already-extracted members and only redoes failed ones
+    """
+
+    tar_path = luigi.Parameter()
+    member_name = luigi.Parameter()
+    ds_dir = luigi.Parameter()
+    prep_list = luigi.ListParameter(default=[])
+    cols_fordrop = luigi.ListParameter(default=[])
+
+    def output(self):
+        # target path carries the task signature:
+        # dataset folder + member name
+        gz_file_name = os.path.basename(self.member_name)
+        return luigi.LocalTarget(
+            os.path.join(self.ds_dir, gz_file_name[:-7], gz_file_name[:-3])
+        )
+
+    def run(self):
+        # member folder is batch-created by ExtractFiles
+        # before the subtasks are yielded
+        output_path = self.output().path
+
+        # gunzip to a temporary name first: the final rename happens
+        # only after the tables are split, so a crash mid-member
+        # leaves no half-done target behind
+        tmp_path = f"{output_path}.part"
+        with tarfile.open(self.tar_path, "r") as tar:
+            member = tar.getmember(self.member_name)
+            # Extract and save in 128 KB chunks,
+            # so the decompressed table never sits in RAM.
+            # BufferedReader gives the inflater big reads from the tar stream
+            with tar.extractfile(member) as gz_file:
+                buffered = io.BufferedReader(gz_file, buffer_size=1 << 17)
+                # big members get multi-threaded inflate via pgzip;
+                # for small ones thread startup would dominate
+                if pgzip is not None and member.size >= PGZIP_MIN_SIZE:
+                    f_in = pgzip.PgzipFile(
+                        fileobj=buffered, mode="rb", thread=os.cpu_count()
+                    )
+                else:
+                    f_in = gzip.open(buffered, "rb")
+                with f_in, open(tmp_path, "wb") as f_out:
+                    shutil.copyfileobj(f_in, f_out, length=128 * 1024)
+
+        # Get 4 tables from file, preprocessing fused in
+        separate_tables(tmp_path, self.prep_list, self.cols_fordrop)
+        os.replace(tmp_path, output_path)
+
+        # record the raw dump in the cleanup manifest, so
+        # DelTempFiles deletes exactly these without a tree walk
+        with open(os.path.join(self.ds_dir, "temp_files.txt"), "a") as f:
+            f.write(f"{output_path}\n")
 
 
 class ExtractFiles(luigi.Task):
     """
-    Unzip downloaded file recursively 
+    Unzip downloaded file recursively
     Get separate tables from downloaded files and save them
     """
 
     data_name = luigi.Parameter()
     dest_folder = luigi.Parameter()
+    prep_list = luigi.ListParameter(default=[])
+    cols_fordrop = luigi.ListParameter(default=[])
 
     # chain with previous step in pipeline
     def requires(self):
@@ -77,61 +279,39 @@ class ExtractFiles(luigi.Task):
 
     def run(self):
         # create another folder for archive
-        ds_dir = os.path.join(self.dest_folder, self.data_name)
-        os.makedirs(ds_dir, exist_ok=True)
-
-        # Open tarfile
-        with tarfile.open(self.input().path, "r") as tar:
-            # Iterate tar
-            for member in tar.getmembers():
-                # Check for gz extension
-                if member.isfile() and member.name.endswith(".gz"):
-                    # get basename
-                    gz_file_name = os.path.basename(member.name)
-
-                    # Create dir for file (if absent)
-                    folder_name = os.path.join(ds_dir, gz_file_name[:-7])
-                    os.makedirs(folder_name, exist_ok=True)
-
-                    # Extract and save
-                    with tar.extractfile(member) as gz_file:
-                        if gz_file is not None:
-                            output_path = os.path.join(folder_name, gz_file_name[:-3])
-                            with gzip.open(gz_file, "rb") as f_in:
-                                with open(output_path, "wb") as f_out:
-                                    f_out.write(f_in.read()) 
-
-                    # Get 4 tables from file
-                    self.separate_tables(output_path)
+        ds_dir = Path(self.dest_folder) / self.data_name
+        ds_dir.mkdir(parents=True, exist_ok=True)
+
+        # Only list member names here; the extraction itself is
+        # one dynamic dependency per member, scheduled by Luigi.
+        # "r|" streams the archive sequentially instead of
+        # indexing the whole file up front like getmembers()
+        with tarfile.open(self.input().path, mode="r|") as tar:
+            members = [
+                member.name
+                for member in tar
+                if member.isfile() and member.name.endswith(".gz")
+            ]
+
+        # batch-create the unique member folders here once,
+        # instead of one makedirs (and its stat) per subtask
+        for folder in {os.path.basename(name)[:-7] for name in members}:
+            (ds_dir / folder).mkdir(exist_ok=True)
+
+        yield [
+            ExtractOneMember(
+                tar_path=self.input().path,
+                member_name=name,
+                ds_dir=str(ds_dir),
+                prep_list=self.prep_list,
+                cols_fordrop=self.cols_fordrop,
+            )
+            for name in members
+        ]
 
         with self.output().open("w") as f:
             f.write(f"Base archive is in the folder: {ds_dir}\n")
-            f.write(f"Tables are extracted from files and written in separate .tsv files")
-
-    # Convert tables into .tsv files
-    def separate_tables(self, fname):
-        dfs = {}
-        with open(fname, "r") as f:
-            write_key = None
-            fio = io.StringIO()
-            for l in f.readlines():
-                if l.startswith("["):
-                    if write_key:
-                        fio.seek(0)
-                        header = None if write_key == "Heading" else "infer"
-                        dfs[write_key] = pd.read_csv(fio, sep="\t", header=header)
-                    fio = io.StringIO()
-                    write_key = l.strip("[]\n")
-                    continue
-                if write_key:
-                    fio.write(l)
-            fio.seek(0)
-            dfs[write_key] = pd.read_csv(fio, sep="\t")
-
-        # save into separate .tsv files
-        for key, df in dfs.items():
-            output_file = Path(fname).parent / f"{key}.tsv"
-            df.to_csv(output_file, sep="\t", index=False)
+            f.write(f"Tables are extracted from files and written in separate .parquet files")
 
 
 class DataPreprocessing(luigi.Task):
@@ -147,40 +327,74 @@ class DataPreprocessing(luigi.Task):
     cols_fordrop = luigi.ListParameter()
 
     # chain with ExtractFiles task,
-    # because of Probes table
+    # because of Probes table.
+    # prep_list/cols_fordrop go along, so the column drop
+    # happens during extraction and this task is normally
+    # just a completion check
     def requires(self):
         return ExtractFiles(
-            data_name=self.data_name, dest_folder=self.dest_folder
+            data_name=self.data_name,
+            dest_folder=self.dest_folder,
+            prep_list=self.prep_list,
+            cols_fordrop=self.cols_fordrop,
         )
 
-    def output(self):
-        ds_dir = Path(os.path.join(self.dest_folder, self.data_name))
-        files = []
+    # every pattern together with its preprocessed counterpart
+    def _patterns(self):
+        pairs = []
         for pattern in self.prep_list:
-            f_preprocess = list(ds_dir.rglob(pattern))
-            if f_preprocess:
-                for fl in f_preprocess:
-                    name, ext = os.path.splitext(fl)
-                    files.append(f"{name}_preprocessed{ext}")
+            name, ext = os.path.splitext(parquet_pattern(pattern))
+            pairs.append((f"{name}{ext}", f"{name}_preprocessed{ext}"))
+        return pairs
+
+    # one walk covers every pattern; no caching across calls,
+    # because with several workers run() happens in a forked
+    # process and a stale pre-extraction cache in the parent
+    # would keep output() empty forever
+    def _scan(self):
+        ds_dir = Path(os.path.join(self.dest_folder, self.data_name))
+        patterns = [p for pair in self._patterns() for p in pair]
+        return scan_patterns(ds_dir, patterns)
 
+    def output(self):
+        found = self._scan()
+        files = []
+        for pattern, prep_pattern in self._patterns():
+            # fused path: extraction already wrote the final file
+            files.extend(str(fl) for fl in found[prep_pattern])
+            # fallback: matches that still need preprocessing
+            for fl in found[pattern]:
+                name, ext = os.path.splitext(fl)
+                files.append(f"{name}_preprocessed{ext}")
+
+        # a file can show up on both sides; keep each target once
+        files = list(dict.fromkeys(files))
         return [luigi.LocalTarget(file_name) for file_name in files]
 
     def run(self):
-        ds_dir = Path(os.path.join(self.dest_folder, self.data_name))
+        # freeze the drop list once: the ListParameter tuple
+        # would otherwise be rebuilt into a set per file
+        drop_set = frozenset(self.cols_fordrop)
 
-        # find all needed files inside ds_dir
-        for pattern in self.prep_list:
+        found = self._scan()
+
+        # find files the fused pass did not cover
+        for pattern, _ in self._patterns():
             # get path list for founded files
-            f_preprocess = list(ds_dir.rglob(pattern))
+            f_preprocess = found[pattern]
             if f_preprocess:
                 for fl in f_preprocess:
-                    # get daraframes from files
-                    df = pd.read_csv(fl, sep="\t")
-                    # drop useless columns
-                    df_prep = df.drop(columns=list(self.cols_fordrop), errors="ignore")
-                    # set new file names and save
+                    # parquet is columnar: the schema gives the header
+                    # for free and only the kept columns' bytes
+                    # are read from disk at all
+                    schema = pq.read_schema(fl)
+                    keep = [c for c in schema.names if c not in drop_set]
+                    # set new file name
                     name, ext = os.path.splitext(fl)
-                    df_prep.to_csv(f"{name}_preprocessed{ext}", sep="\t", index=False)
+                    table = pq.read_table(fl, columns=keep)
+                    pq.write_table(
+                        table, f"{name}_preprocessed{ext}", compression="snappy"
+                    )
 
 
 class DelTempFiles(luigi.Task):
@@ -229,15 +443,28 @@ class DelTempFiles(luigi.Task):
             os.remove(path_ds)
             del_files.append(path_ds)
 
-        for txt_file in ds_dir.rglob("*.txt"):
-            os.remove(txt_file)
-            del_files.append(txt_file)
+        # the extraction manifest lists the raw dumps exactly,
+        # so no directory walk is needed; fall back to the
+        # scandir sweep if it is missing
+        manifest = ds_dir / "temp_files.txt"
+        if manifest.exists():
+            with open(manifest) as f:
+                targets = [line.strip() for line in f if line.strip()]
+            for fl in targets:
+                if os.path.exists(fl):
+                    os.unlink(fl)
+                    del_files.append(fl)
+            os.unlink(manifest)
+            del_files.append(str(manifest))
+        else:
+            for txt_file in walk_ext(ds_dir, ".txt"):
+                os.unlink(txt_file)
+                del_files.append(txt_file)
 
-        # save logs
+        # save logs in one write instead of a line per file
         with self.output().open("w") as f:
             f.write("Pipeline completed.\n Temporary files deleted:\n")
-            for fl in del_files:
-                f.write(f" - {fl}\n")
+            f.write("".join(f" - {fl}\n" for fl in del_files))
 
 
 class CreateDataSet(luigi.WrapperTask):